@@ -142,11 +142,15 @@ Nat Kuhn (NSK, nk@natkuhn.com)
 # example: #(exp,2,6)'64
 
 from __future__ import print_function   # for Python 3 compatibility
-import re, sys, os, time
+import re, sys, os, time, bisect, itertools, collections, signal, operator
 try:
   import cPickle as pickle                # for SB and FB
 except:
   import pickle
+try:
+  intern                                  # for textchunk
+except NameError:
+  from sys import intern                  # Python 3
 
 class form:
     """a 'form' is a 'defined string.' It is stored as a list; each element in 
@@ -162,9 +166,14 @@ class form:
     the next chunk.  Hence, if the pointer is at the 'far right' of the form, 
     chunkp points to the terminating endchunk."""
     
+    names = []      # the keys of forms, kept sorted for LN
+    incache = None  # memo of IN searches, see initial(); cleared by segment()
+    INCACHESIZE = 256
+    INCACHEMAX = 64     # longer IN texts and results are not kept in the memo
+    
     def __init__(self, name, string):
         self.name = name
-        forms[name] = self
+        form.define(self)
         if string == '':
             self.formlist = [endchunk()]
         else:
@@ -172,16 +181,35 @@ class form:
         self.chunkp = 0     #which chunk has the form pointer
         self.enterchunk()
     
+    def __getstate__(self):     # for SB: leave the IN memo out of the block
+        state = self.__dict__.copy()
+        state.pop('incache', None)
+        return state
+    
     def val(self,*args):        # for CL
-        return ''.join(map(lambda x: x.valchunk(*args),self.formlist[self.chunkp:]))
+        parts = []
+        nargs = len(args)
+        for c in itertools.islice(self.formlist, self.chunkp, None):
+            if isinstance(c, textchunk):
+                parts.append(c.text if c.pointer == -1 else c.text[c.pointer:])
+            elif isinstance(c, gapchunk):
+                if c.gapno < nargs: parts.append(args[c.gapno])
+            # an endchunk contributes nothing
+        return ''.join(parts)
     
     def segment(self,*args):    # for SS
         self.exitchunk()   
         for segno in range(len(args)):
             segstr = args[segno]
             if segstr == '': continue   # can't segment out null string
-            segmented = map( lambda x: x.segmentchunk(segno,segstr), self.formlist )
-            self.formlist = sum(segmented , [])
+            out = []
+            for c in self.formlist:     # only textchunks get segmented
+                if isinstance(c, textchunk):
+                    out.extend(c.segmentchunk(segno,segstr))
+                else:
+                    out.append(c)
+            self.formlist = out
+        self.incache = None
         chunkp = 0          #per Mooers, the form pointer is moved to the left end
         self.enterchunk()
 
@@ -235,31 +263,35 @@ class form:
             self.enterchunk()
     
     def getPrevChar(self):  # only called after toPrevChar returns False
-        p = self.curchunk().pointer
+        c = self.curchunk()
+        p = c.pointer
         assert p >= 0
         if p > 0:   #inside a text chunk
             p -= 1
-            self.curchunk().pointer = p
-            return self.curchunk().text[p]
+            c.pointer = p
+            return c.text[p]
         else:       #just after a text chunk, at gap or right end
             self.exitchunk()
             self.chunkp -= 1
             self.enterchunk()
             c = self.curchunk()
-            c.pointer = len(c.text) - 1
-            return c.text[c.pointer]
+            text = c.text
+            p = len(text) - 1
+            c.pointer = p
+            return text[p]
     
     def validate(self):
-        """form.validate() makes sure that a form is valid.  The main loop 
-        (psrs(), below) checks each form every time through.  I caught some 
-        bugs this way I might not have otherwise."""
+        """form.validate() makes sure that a form is valid.  With #(mo,s,+d), 
+        the main loop (psrs(), below) checks each form every time through.  
+        I caught some bugs this way I might not have otherwise."""
         activecount = 0 # chunks with c.pointer>=0, all but 1 chunk should have -1.
         endcount = 0    # endchunks
         previstext = False  # if the previous chunk was text (can't have two in a row)
         invalid = False
         for c in self.formlist:
             if c.pointer >= 0: activecount += 1
-            if isinstance(c, textchunk):
+            t = c.__class__     # chunks are old-style classes in Python 2
+            if t is textchunk:
                 if previstext:
                     ourOS.print_('Invalid form: consecutive text chunks in', self.name, \
                         ':',c.text,'and previous')
@@ -276,7 +308,7 @@ class form:
             if c.pointer < -1 or c.pointer > 0:
                     ourOS.print_('Invalid pointer (',c.pointer,') in gapchunk or endchunk')
                     invalid = True
-            if isinstance(c, endchunk): endcount+=1
+            if t is endchunk: endcount+=1
         if activecount != 1:
             ourOS.print_('Invalid form:',activecount,'active chunks in',self.name)
             invalid = True
@@ -289,12 +321,13 @@ class form:
         if invalid: ourOS.print_('Invalid form',self.name, ': [', *self.formlist)
         
     def __str__(self):  # used in PF, so the str functions put in the form pointer as <^>
-        return ''.join(map(str, self.formlist))
+        return ''.join(str(c) for c in self.formlist)
     
     @staticmethod
     def find(name):     # terminates the primitive if the form not found
-        if name in forms: return forms[name]
-        else: form.FNFError(name)
+        f = forms.get(name)
+        if f is None: form.FNFError(name)
+        return f
     
     @staticmethod
     def callCharacter(name,default):    # for CC
@@ -310,27 +343,23 @@ class form:
         if sgn != '-':      #either '+' or ''
             if f.atend():
                 return (default, True)               #return default only if AT end
-            if n == 0:
-                f.toNextChar()
-                return
-            chrs = ''
-            while n > 0:
-                if f.toNextChar(): return (chrs, False)   #null if advancing yields nothing
-                chrs += f.getNextChar()
-                n -= 1
-            return (chrs, False)    # got 'em all, pointer remains to the right of last char
+            (tochar, getchar) = (f.toNextChar, f.getNextChar)
         else:   # sign == '-'...including -0
             if f.chunkp == 0 and f.formlist[0].pointer == 0:
                 return (default, True)  #return default only if AT start
-            if n == 0:
-                f.toPrevChar()
-                return
-            chrs = ''
-            while n < 0:
-                if f.toPrevChar(): return (chrs, False) #null if no previous char
-                chrs = f.getPrevChar() + chrs   #"prepend" the next character
-                n += 1
-            return (chrs, False)    # got 'em all, pointer remains to the left of last char
+            (tochar, getchar) = (f.toPrevChar, f.getPrevChar)
+        if n == 0:
+            tochar()
+            return
+        chrs = []
+        count = abs(n)
+        while count > 0:
+            if tochar(): break      #null if no more characters that way
+            chrs.append(getchar())
+            count -= 1
+        # pointer remains beyond the last char; backwards, chrs are reversed
+        if sgn == '-': chrs.reverse()
+        return (''.join(chrs), False)
     
     @staticmethod
     def callSeg(name,default):          # for CS
@@ -347,32 +376,57 @@ class form:
         f.enterchunk()
         return (text, False)
 
+    @staticmethod
+    def define(f):      # adds f to forms, replacing any form of the same name
+        if f.name not in forms: bisect.insort(form.names, f.name)
+        forms[f.name] = f
+    
+    @staticmethod
+    def undefine(name): # removes a form, returns False if there was none
+        if forms.pop(name, None) is None: return False
+        del form.names[bisect.bisect_left(form.names, name)]
+        return True
+    
     @staticmethod
     def deleteall():                    # for DA
         global forms    #for some reason, needed here, but not in 'define', above
         forms = {}
+        form.names = []
     
     @staticmethod
     def deletedef(*args):               # for DD
         for name in args:
-            try:
-                del forms[name]
-            except:
-                if Mode.unforgiving(): form.FNFError(name)
+            if not form.undefine(name) and Mode.isunforgiving:
+                form.FNFError(name)
     
-    @staticmethod
-    def initial(name,text,default):     # for IN
-        f = form.find(name)
-        findp = f.chunkp
+    def search(self,text):  # for initial(): returns (val, findp, idx)
         val = ''
-        for chunk in f.formlist[f.chunkp:]:
+        chunks = itertools.islice(self.formlist, self.chunkp, None)
+        for (findp, chunk) in enumerate(chunks, self.chunkp):
             (idx, string) = chunk.find(text)
             val += string
-            if idx == -1:
-                findp += 1
-                continue
-            break
-        else:
+            if idx >= 0: return ( val, findp, idx )
+        return ( '', None, -1 )    # not found; initial() doesn't use val
+    
+    @staticmethod
+    def initial(name,text,default):     # for IN
+        f = form.find(name)
+        # the result depends only on the form pointer and the chunks, which
+        # change only through segment()
+        # only short entries are kept, so a memo can't pin many copies of a 
+        # long form; misses, which don't move the pointer, carry no text
+        memo = len(text) <= form.INCACHEMAX
+        if memo:
+            key = (f.chunkp, f.curchunk().pointer, text)
+            if f.incache is None: f.incache = {}
+            found = f.incache.get(key)
+        if not memo or found is None:
+            found = f.search(text)
+            if memo and len(found[0]) <= form.INCACHEMAX:
+                if len(f.incache) >= form.INCACHESIZE: f.incache = {}
+                f.incache[key] = found
+        (val, findp, idx) = found
+        if findp is None:
             return ( default, True)
         assert idx >= 0
         f.exitchunk()
@@ -396,9 +450,6 @@ class formchunk:
     def isend(self):
         return False
 
-    def segmentchunk(self,gapno,string):  # only segment textchunks
-        return [self]
-    
     def charavail(self):
         return False
     
@@ -407,55 +458,66 @@ class formchunk:
     
 class textchunk(formchunk):
     """this chunk is for a continuous stream of text between segment gaps"""
+    INTERNMAX = 4096    # longer texts are not worth a slot in the intern table
+    
     def __init__(self,text):
-        self.text = text
+        self.text = intern(text) if len(text) < textchunk.INTERNMAX else text
         self.pointer = -1
     
-    def valchunk(self,*args):
-        return self.text if self.pointer == -1 else self.text[self.pointer:]
-    
     def getseg(self):
         assert self.pointer >= 0
         return (self.text[self.pointer:], True)  #advance past following segment gap
     
     def segmentchunk(self,gapno,string):
         out = []
-        for piece in self.text.split(string):    #will always execute at least once
-            if piece != '': out.append(textchunk(piece))
+        t = self.text
+        i = 0
+        while True:
+            j = t.find(string, i)
+            if j < 0:
+                if i < len(t): out.append(textchunk(t[i:]))
+                return out
+            if j > i: out.append(textchunk(t[i:j]))
             out.append(gapchunk(gapno))
-        out.pop()   # remove final gap
-        return out
+            i = j + len(string)
     
     def getNextCh(self):
-        ch = self.text[self.pointer]
-        self.pointer += 1
-        if self.pointer == len(self.text):
+        text = self.text
+        p = self.pointer
+        ch = text[p]
+        p += 1
+        if p == len(text):
             self.pointer = -1   # perhaps not necessary
             return (ch, True)   # move form pointer to next chunk
         else:
+            self.pointer = p
             return (ch, False)
     
     def charavail(self):
         return True     #by definition, pointer is not at end
     
     def find(self,findstr):
+        if not findstr: return ( -1, '' )  # IN gives the default anyway
         start = self.pointer if self.pointer >= 0 else 0
-        find = -1 if findstr == ''  else self.text.find(findstr, start)
-        return ( find, self.text[start:] if find < 0 else self.text[start:find] )
+        text = self.text
+        i = text.find(findstr, start)
+        if i < 0:
+            return ( -1, text[start:] if start else text )
+        return ( i, '' if i == start else text[start:i] )
 
     def __str__(self):
-        return self.text if self.pointer == -1 \
-            else self.text[0:self.pointer] + '<^>' + self.text[self.pointer:]
+        if self.pointer == -1: return self.text
+        t, p = self.text, self.pointer
+        return '%s<^>%s' % (t[:p], t[p:])
 
 class gapchunk(formchunk):
-    """This chunk represents a segment gap"""
+    """This chunk represents a segment gap.  Don't pool or share these: the 
+    pointer field marks the form pointer, so every gap must be its own 
+    object (see the v0.9 note above)."""
     def __init__(self,gapno):
         self.gapno = gapno
         self.pointer = -1
     
-    def valchunk(self,*args):
-        return args[self.gapno] if self.gapno<len(args) else ''
-    
     def getseg(self):
         return ('', False)  #advance to next chunk, not past it
     
@@ -473,9 +535,6 @@ class endchunk(formchunk):
     def isend(self):
         return True
         
-    def valchunk(self, *args):
-        return ''   # value for CL
-    
     def getseg(self):   #value for CS--should never happen
         assert False
         
@@ -510,13 +569,17 @@ class TheOS:
         print(*args,**kwargs)
         return
     
+    def write(self,text):   # for AnsiConsole.flushout()
+        self.print_(text, end='')
+    
     def getscrsize(self):
         return None
     
 class WindowsOS(TheOS):
     def __init__(self):
-        aw = self.getsizeenv()
-        self.ansiwidth = aw[1] if aw else None
+        # os.environ is a snapshot taken at startup, so ANSICON is parsed once
+        self.sizeenv = self.parsesizeenv()
+        self.ansiwidth = self.sizeenv[1] if self.sizeenv else None
     
     def getraw(self):
         import msvcrt
@@ -544,7 +607,7 @@ class WindowsOS(TheOS):
                 return AnsiConsole.DEL # at least for fn-delete on VMWare
             else:
                 tc.bell()     #for the alpha, better late than never
-                tc.inbuf = ch + tc.inbuf    # reprocess the character
+                tc.inbuf.appendleft(ch)    # reprocess the character
         elif code == 0:     # NUL
             ch = tc.inkey()
             code = ord(ch)
@@ -558,7 +621,7 @@ class WindowsOS(TheOS):
                 tc.dohist('f')
             else:
                 tc.bell()     #for the alpha, better late than never
-                tc.inbuf = ch + tc.inbuf    # reprocess the character
+                tc.inbuf.appendleft(ch)    # reprocess the character
         else:
             tc.bell()
 
@@ -587,8 +650,11 @@ class WindowsOS(TheOS):
         else:
             return None
     
-    ANSIre = re.compile('(\d+)x(\d+)\s*\((\d+)x(\d+)\)\Z')  #wxh(WxH)
+    ANSIre = re.compile(r'(\d+)x(\d+)\s*\((\d+)x(\d+)\)\Z')  #wxh(WxH)
     def getsizeenv(self):
+        return self.sizeenv
+    
+    def parsesizeenv(self):
         e = os.getenv('ANSICON')
         if e == None:
             return None
@@ -651,7 +717,7 @@ class PosixOS(TheOS):
                     tc.dohist(ch)
                 else:
                     tc.bell()     #for the ESC, better late than never
-                    tc.inbuf = ch + tc.inbuf    # reprocess the character
+                    tc.inbuf.appendleft(ch)    # reprocess the character
     
     def getscrsize(self):
         # from http://stackoverflow.com/questions/566746/
@@ -682,6 +748,16 @@ class PosixOS(TheOS):
     
     def newInputString(self,str,point):
         return InputString(str,point)
+    
+    def write(self,text):
+        """writes to the terminal with os.write, skipping print() and the 
+        stdout buffer; anything already printed has to go out first"""
+        sys.stdout.flush()
+        if not isinstance(text, bytes):     # Python 3
+            text = text.encode(sys.stdout.encoding or 'utf-8', 'replace')
+        fd = sys.stdout.fileno()
+        while text:
+            text = text[os.write(fd, text):]
 
 class CygwinOS(PosixOS):
     def __init__(self):
@@ -699,6 +775,9 @@ class CygwinOS(PosixOS):
         else:
             PosixOS.print_(self, *args, end='\r\n', **kwargs)
     
+    def write(self,text):
+        PosixOS.write(self, '\r\n'.join(text.split('\n')))
+    
 class UnknownOS(TheOS):
     #TODO add getraw method to reset to line-mode
     def defaultterm(self):
@@ -706,7 +785,7 @@ class UnknownOS(TheOS):
 
 class Console(object):
     def __init__(self, *args):
-        self.inbuf = ''
+        self.inbuf = collections.deque()    # pending input characters
         self.settype(*args)
     
     def settype(self,*args):
@@ -718,8 +797,7 @@ class Console(object):
 
     def inkey(self):
         if self.inbuf:
-            ch = self.inbuf[0]
-            self.inbuf = self.inbuf[1:]
+            ch = self.inbuf.popleft()
         else:
             ch = ourOS.getraw()
         code = ord(ch)
@@ -766,47 +844,48 @@ class BasicConsole(Console):
             the echoing mode.
         """
         global rshistory
-        string = ''
+        chars = []      # the string so far, joined when it is returned
         mc = metachar.get()
         echoing = False #set to true when we BS past \n
+        print_, inkey, bell = ourOS.print_, self.inkey, self.bell
         while True:
-            ch = self.inkey()
+            ch = inkey()
             code = ord(ch)
             if code == 127 or ch == '\b': # backspace (mac or Windows)
-                if string == '':
-                    self.bell()
+                if not chars:
+                    bell()
                     continue
                 # print a space over the character immediately preceding the cursor
                 # but we can't backspace over newlines
-                if string[-1] == '\n' and not echoing:
-                    ourOS.print_('\\',end='')
+                last = chars.pop()
+                if last == '\n' and not echoing:
+                    print_('\\',end='')
                     echoing = True
-                ourOS.print_(string[-1] if echoing else '\b \b',end='')
-                string = string[:-1]
-                if string == '' and echoing:
-                    ourOS.print_('\\',end='')
+                print_(last if echoing else '\b \b',end='')
+                if not chars and echoing:
+                    print_('\\',end='')
                     echoing = False
             else:   #anything else
                 if echoing:
-                    ourOS.print_('\\',end='')
+                    print_('\\',end='')
                     echoing = False
-                ourOS.print_(ch, end='')
+                print_(ch, end='')
                 if ch == mc:
                     sys.stdout.flush()
+                    string = ''.join(chars)
                     rshistory.append( string )
                     return string
                 else:
-                    string += ch
+                    chars.append(ch)
 
 class LineConsole(Console):
     def inkey(self):
-        if self.inbuf == '':
-            self.inbuf = sys.stdin.readline()
-        if self.inbuf == '':    #we've hit EOF
-            raise tracHalt
-        ch = self.inbuf[0]
-        self.inbuf = self.inbuf[1:]
-        return ch
+        if not self.inbuf:
+            line = sys.stdin.readline()
+            if not line:    #we've hit EOF
+                raise tracHalt
+            self.inbuf.extend(line)
+        return self.inbuf.popleft()
     
     def readch(self):
         return self.inkey()
@@ -814,18 +893,20 @@ class LineConsole(Console):
     def readstr(self, *args):
         global rshistory
         prim.condTMA(args, 0)
-        string = ''
+        chars = []      # the string so far, joined when it is returned
         mc = metachar.get()
+        inkey = self.inkey
         while True:
-            ch = self.inkey()
+            ch = inkey()
             if ch == mc:
-                if mc != '\n' and self.inbuf[0] == '\n':
+                if mc != '\n' and self.inbuf and self.inbuf[0] == '\n':
                     #strip \n immed following meta
-                    self.inbuf = self.inbuf[1:]
+                    self.inbuf.popleft()
+                string = ''.join(chars)
                 rshistory.append( string )
                 return string
             else:
-                string += ch
+                chars.append(ch)
 
 ESC = chr(27)
 
@@ -896,15 +977,26 @@ class AnsiConsole(Console):
     
     BS = 8
     DEL = 127
+    FINALCH = frozenset(chr(c) for c in range(64, 127))  # end a CSI sequence
     
     def __init__(self, *args):
         self.fixedsize = AnsiConsole.DEFSIZE
         self.carriagepos = 0
         self.sb = SwitchBank('otsefdlv', 'oel')
+        self.outbuf = []    # screen output waiting for flushout()
+        self.knownloc = None    # (inp, point, scrsize) as cursorto() left it
+        self.sizeknown = False  # True while scrsize needs no refreshing
+        try:    # where the OS reports resizes, refreshsize() can wait for one
+            signal.signal(signal.SIGWINCH, self.winch)
+            signal.siginterrupt(signal.SIGWINCH, False)  # don't break getraw()
+            self.haswinch = True
+        except (AttributeError, ValueError):    # e.g. Windows
+            self.haswinch = False
         Console.__init__(self, *args)
     
     def settype(self, type, *args):
         prim.condTMA(args, 3, offset=2, atmost=True)
+        self.sizeknown = False      # switches or fixed size may change
         self.contype = type.lower()
         if len(args) >= 1:
             self.sb.flip(args[0])
@@ -931,11 +1023,35 @@ class AnsiConsole(Console):
         return
     
     def printstr(self,text):
+        self.flushout()
         Console.printstr(self,text)
         self.adjustcarriage(text)
         return
     
+    # RS output (cursor movement, erasing, echo) is gathered in outbuf and 
+    # written out in one piece before the next keystroke or device poll is read
+    def write(self,text):
+        self.outbuf.append(text)
+    
+    def flushout(self):
+        if self.outbuf:
+            ourOS.write(''.join(self.outbuf))
+            self.outbuf = []
+        sys.stdout.flush()
+    
+    def inkey(self):
+        self.flushout()
+        return Console.inkey(self)
+    
+    def bell(self):
+        self.write(chr(7))
+    
+    def winch(self, signum, frame):     # SIGWINCH: the window was resized
+        self.sizeknown = False
+    
     def refreshsize(self):
+        if self.sizeknown: return   # no resize since the last time
+        self.sizeknown = self.haswinch
         self.results = []
         self.trysize('o', 'OS', ourOS.getscrsize)
         self.trysize('t', 'terminal poll', self.sizepoll)
@@ -950,6 +1066,8 @@ class AnsiConsole(Console):
             for ( size, source ) in self.results[1:]:
                 if size == self.scrsize:
                     continue
+                self.flushout()
+                self.knownloc = None
                 ourOS.print_("Screen size discrepancy:",self.scrsize,'from',\
                     scrsource,"vs",size,'from',source)
                 discrep = True
@@ -968,7 +1086,7 @@ class AnsiConsole(Console):
             self.results.append( (size, name) )
                 
     def sizepoll(self):
-        ourOS.print_(ESC + '[1 8t', end='')
+        self.write(ESC + '[1 8t')
         return self.getcoords('t','8',';')
     
     def sizeproc(self):
@@ -989,14 +1107,15 @@ class AnsiConsole(Console):
         escape sequences.
         If it takes > 50 msec to get to ESC, we conclude that device-polling
         is not working."""
+        self.flushout()     # send the poll
         time0 = time.time()
         while True:
             ch = ourOS.getraw()
             if (time.time() - time0) <= 0.05:
                 if ch == ESC: break
-                self.inbuf += ch
+                self.inbuf.append(ch)
             else:
-                self.inbuf += ch
+                self.inbuf.append(ch)
                 return None
         seq = self.geteseq()
         start = ['['] + list(args)
@@ -1027,15 +1146,15 @@ class AnsiConsole(Console):
         http://invisible-island.net/xterm/ctlseqs/ctlseqs.html
         """
                     
-        seqlist = []
+        getraw = ourOS.getraw
+        ch = getraw()
+        seqlist = [ch]
+        if ch != '[': return seqlist
+        final = AnsiConsole.FINALCH
         while True:
-            ch = ourOS.getraw()
-            code = ord(ch)
+            ch = getraw()
             seqlist.append(ch)
-            if len(seqlist) == 1:
-                if ch != '[': return seqlist
-            else:   #len > 1
-                if ( (code >= 64) and (code < 127) ): return seqlist
+            if ch in final: return seqlist
     
     def readstr(self, *args):
         """
@@ -1055,6 +1174,7 @@ class AnsiConsole(Console):
         """
         mc = metachar.get()
         self.histpointer = None
+        self.knownloc = None
         #handle arguments to RS
         if len(args) > 0 and Mode.extprim():
             prim.condTMA(args, 2, atmost=True)
@@ -1069,7 +1189,7 @@ class AnsiConsole(Console):
             if startnum < 0: startnum = 0
             startnum = min(startnum, len(startstr) )
             self.inp = InputString.new(startstr, startnum)
-            ourOS.print_(startstr, end='')
+            self.write(startstr)
             self.refreshsize()
             self.inp.cursorisat( len(startstr) )
             self.inp.curtoinspoint()
@@ -1077,78 +1197,90 @@ class AnsiConsole(Console):
             prim.condTMA(args,0)
             self.inp = InputString.new('',0)
         
-        while True:             #RS main loop
-            try:
-                ch = self.inkey()
-            except (KeyboardInterrupt, tracHalt):
-                self.inp.eprint('')
-                raise
-            code = ord(ch)
-            if (code < 32 or code >=127) and ch != '\n':
-                code = ourOS.rsctrl(self.inp, code)
-                if code == None:    #nothing more to process
-                    continue
-            if code == AnsiConsole.BS: # backspace
-                if self.inp.inspoint == 0:
-                    self.bell()
-                    continue
-                self.inp.curatinspoint()
-                tail = self.inp.rstring[self.inp.inspoint:]
-                self.inp.inspoint -= 1
-                head = self.inp.rstring[0:self.inp.inspoint]
-                self.inp.rstring = head+tail
-                self.inp.redolengths()
-                self.inp.curtoinspoint()
-                self.inp.eprint(tail)
-                if self.inp.inspoint == len(self.inp.rstring):
-                    continue        #already in the right place
-                self.inp.cursorisat(len(self.inp.rstring) )
-                self.inp.curtoinspoint()
-            elif code == AnsiConsole.DEL:
-                if self.inp.inspoint == len(self.inp.rstring):
-                    self.bell() #already at end, nothing to del
-                    continue
-                self.inp.curatinspoint()
-                head = self.inp.rstring[0:self.inp.inspoint]
-                tail = self.inp.rstring[self.inp.inspoint+1:]
-                self.inp.rstring = head+tail
-                self.inp.redolengths()
-                self.inp.eprint(tail)
-                if self.inp.inspoint == len(self.inp.rstring):
-                    continue        #just deleted last char
-                self.inp.cursorisat( len(self.inp.rstring) )
-                self.inp.curtoinspoint()
-            else:   #printable or \n
-                self.inp.curatinspoint()
-                head = self.inp.rstring[0:self.inp.inspoint]
-                if ch == mc:    #meta: delete the rest and return the head
-                    self.inp.eprint(ch)
-                    self.adjustcarriage(head + mc)   #remember, mc could be \n
-                    self.inp.rstring = head
-                    self.inp.redolengths()
-                    rshistory.append( head )
-                    sys.stdout.flush()
-                    return head
-                tail = self.inp.rstring[self.inp.inspoint:]
-                self.inp.rstring = head + ch + tail
-                self.inp.redolengths()
-                # there is a knotty problem with hitting the enter key with
-                # cursor at first character of a wrapped line; it should not
-                # change screen but should insert \n
-                if self.inp.colloc == 1 and self.inp.pos > 0 and ch == '\n':
-                    self.inp.eprint(tail)
-                else:
-                    self.inp.eprint(ch + tail) #even if it's printable, need to erase due to linewrapping
-                self.inp.inspoint += 1
-                if self.inp.inspoint != len(self.inp.rstring):
-                    self.inp.cursorisat( len(self.inp.rstring) )
-                    self.inp.curtoinspoint()
-                if ch == ')':
-                    self.inp.parenmatch()        # end of RS main loop
+        try:
+            inkey, rsctrl = self.inkey, ourOS.rsctrl
+            edits = { AnsiConsole.BS: self.dobs, AnsiConsole.DEL: self.dodel }
+            while True:             #RS main loop
+                try:
+                    ch = inkey()
+                except (KeyboardInterrupt, tracHalt):
+                    self.inp.eprint('')
+                    raise
+                code = ord(ch)
+                if (code < 32 or code >=127) and ch != '\n':
+                    code = rsctrl(self.inp, code)
+                    if code == None:    #nothing more to process
+                        continue
+                edit = edits.get(code)
+                if edit:
+                    edit()
+                else:   #printable or \n
+                    head = self.doinsert(ch, mc)
+                    if head != None: return head    # it was the meta char
+        finally:
+            self.flushout()     # whatever this keystroke put on the screen
+    
+    # the RS editing keys; rsctrl() handles cursor movement and history
+    def dobs(self):     # backspace
+        inp = self.inp
+        if inp.inspoint == 0:
+            self.bell()
+            return
+        inp.curatinspoint()
+        inp.inspoint -= 1
+        inp.delchar(inp.inspoint)
+        tail = inp.rstring[inp.inspoint:]
+        inp.curtoinspoint()
+        inp.eprint(tail)
+        if inp.inspoint == len(inp.rstring):
+            return          #already in the right place
+        inp.cursorisat(len(inp.rstring) )
+        inp.curtoinspoint()
+    
+    def dodel(self):    # delete
+        inp = self.inp
+        if inp.inspoint == len(inp.rstring):
+            self.bell() #already at end, nothing to del
+            return
+        inp.curatinspoint()
+        inp.delchar(inp.inspoint)
+        tail = inp.rstring[inp.inspoint:]
+        inp.eprint(tail)
+        if inp.inspoint == len(inp.rstring):
+            return          #just deleted last char
+        inp.cursorisat( len(inp.rstring) )
+        inp.curtoinspoint()
+    
+    def doinsert(self, ch, mc):     # returns the input if ch is the meta char
+        inp = self.inp
+        inp.curatinspoint()
+        if ch == mc:    #meta: delete the rest and return the head
+            head = inp.rstring[0:inp.inspoint]
+            inp.eprint(ch)
+            self.adjustcarriage(head + mc)   #remember, mc could be \n
+            # self.inp is dropped now, so it isn't trimmed to head
+            rshistory.append( head )
+            return head
+        inp.inschar(ch)
+        # there is a knotty problem with hitting the enter key with
+        # cursor at first character of a wrapped line; it should not
+        # change screen but should insert \n
+        if inp.colloc == 1 and inp.pos > 0 and ch == '\n':
+            inp.eprint(inp.rstring[inp.inspoint+1:])   # just the tail
+        else:
+            inp.eprint(inp.rstring[inp.inspoint:]) #ch+tail; even if it's printable, need to erase due to linewrapping
+        inp.inspoint += 1
+        if inp.inspoint != len(inp.rstring):
+            inp.cursorisat( len(inp.rstring) )
+            inp.curtoinspoint()
+        if ch == ')':
+            inp.parenmatch()
+        return None
     
     def dohist(self, dir):
         if self.histpointer == None:    #set up history
-            self.histcopy = map(lambda x: InputString.new(x,len(x)), rshistory)
+            # entries become InputStrings only when they are visited
+            self.histcopy = list(rshistory)
             self.histpointer = len(self.histcopy)
             self.histcopy.append(self.inp)
         if dir == 'b':       #move back
@@ -1165,14 +1297,25 @@ class AnsiConsole(Console):
                 self.histpointer += 1
         else:
             assert False
-        self.inp.curatinspoint()
-        self.inp.cursorto(0)
-        
-        #now need to show the new self.inp
         newinp = self.histcopy[self.histpointer]
+        if not isinstance(newinp, InputString):     # first visit
+            newinp = InputString.new(newinp, len(newinp))
+            self.histcopy[self.histpointer] = newinp
         self.refreshsize()
-        newinp.cursorisat(0)
-        newinp.eprint(newinp.rstring)
+        # the screen already shows the prefix the two strings have in common
+        same = len(os.path.commonprefix( (self.inp.rstring, newinp.rstring) ))
+        # but at a wrap column the cursor may or may not hang, depending on 
+        # what follows, so the two strings can disagree; back up into the row
+        if same > 0:    # at 0 the whole entry is redrawn, as before
+            (line, pos) = self.inp.lineof(same)
+            if pos > 0 and pos % tc.scrsize[1] == 0:
+                same -= 1
+        self.inp.curatinspoint()
+        self.inp.cursorto(same)
+        
+        #now need to show the rest of the new self.inp
+        newinp.cursorisat(same)
+        newinp.eprint(newinp.rstring[same:])
         self.inp = newinp
         if newinp.inspoint == len(newinp.rstring):
             return        #already in the right place
@@ -1251,6 +1394,10 @@ class InputString(object):
         and at the END of RS
     """
     FLASHSECS = .150    # amount of time to flash for paren matching
+    # scrgoto's escape sequences, prebuilt for the usual small moves
+    UPSEQ = [ESC + '[%dA' % i for i in range(128)]
+    DOWNSEQ = [ESC + '[%dB' % i for i in range(128)]
+    COLSEQ = [ESC + '[%dG' % i for i in range(256)]
     
     @staticmethod
     def new(str,point):
@@ -1267,6 +1414,41 @@ class InputString(object):
     def redolengths(self):
         self.linelengths = map(len,self.rstring.split('\n'))
         self.linelengths[0] += tc.carriagepos
+        self.loccache = {}
+    
+    # inschar() and delchar() edit rstring and adjust linelengths to match, 
+    # rather than re-splitting the whole string with redolengths()
+    def lineof(self, point):
+        """returns (line, pos) for 'point' without touching the cursor state
+        the way posfrompoint() does; a \n belongs to the line it ends"""
+        pos = tc.carriagepos + point
+        for line, ll in enumerate(self.linelengths):
+            if pos <= ll: return (line, pos)
+            pos -= ll + 1
+        raise termError("Logic error (lineof): point=",point, \
+            'linelengths=',self.linelengths)
+    
+    def inschar(self, ch):  # insert ch at inspoint, which does not move
+        p = self.inspoint
+        (line, pos) = self.lineof(p)
+        r = self.rstring
+        self.rstring = ''.join( (r[:p], ch, r[p:]) )    # one new string
+        self.loccache = {}
+        if ch == '\n':
+            ll = self.linelengths[line]
+            self.linelengths[line:line+1] = [pos, ll - pos]
+        else:
+            self.linelengths[line] += 1
+    
+    def delchar(self, point):   # delete the character at point
+        (line, pos) = self.lineof(point)
+        if self.rstring[point] == '\n':    # join this line and the next
+            self.linelengths[line:line+2] = \
+                [self.linelengths[line] + self.linelengths[line+1]]
+        else:
+            self.linelengths[line] -= 1
+        self.rstring = self.rstring[:point] + self.rstring[point+1:]
+        self.loccache = {}
     
     def posfrompoint(self, point):
         """
@@ -1278,34 +1460,49 @@ class InputString(object):
         be in hanging position.
         
         used in cursorisat() and cursorto()
+        
+        results are cached in loccache by point and screen width until the 
+        string is edited; findpoint() does the actual work
         """
+        key = (point, tc.scrsize[1])
+        loc = self.loccache.get(key)
+        if loc is None:
+            self.findpoint(point)
+            self.loccache[key] = (self.line, self.pos, self.colloc, \
+                self.rowsdown, self.hanging)
+        else:
+            self.curpoint = point
+            (self.line, self.pos, self.colloc, self.rowsdown, self.hanging) = loc
+    
+    def findpoint(self, point):
         self.curpoint = point
-        self.pos = tc.carriagepos + point
+        pos = tc.carriagepos + point
+        cols = tc.scrsize[1]
         rd = 0
-        for self.line in range(len(self.linelengths)):
-            ll = self.linelengths[self.line]
-            self.colloc = self.pos % tc.scrsize[1] + 1
-            if self.pos == 0 or self.pos < ll:    #not hanging, for sure
-                self.rowsdown = rd + self.pos // tc.scrsize[1]
-                self.hanging = False
-                return
-            if self.pos == ll:  #hanging, if scrsize[1] goes into chars evenly
-                self.rowsdown = rd + (self.pos-1) // tc.scrsize[1]
-                if self.colloc == 1:
-                    self.hanging = True
-                    self.colloc = tc.scrsize[1]
-                else:
-                    self.hanging = False
-                return
-            self.pos -= (ll + 1)       # count 1 for the \n
-            rd += max(0, ll-1) // tc.scrsize[1] + 1           # same here
+        # skip whole lines; only the line the point is in needs the details
+        for (line, ll) in enumerate(self.linelengths):
+            if pos <= ll: break
+            pos -= (ll + 1)       # count 1 for the \n
+            rd += max(0, ll-1) // cols + 1           # same here
                 # use ll-1 because an 80-char line on an 80-char screen won't 
                 # wrap, i.e. the returned value says "if I just printed that, 
                 # how many lines down will I be," rather than "if I want to 
                 # move the insertion point here, how many lines down should 
                 # it be?" #hangovereffect
-        raise termError("Logic error (posline): curpoint=",self.curpoint, \
-            'linelengths=',self.linelengths, ", overflow=",self.pos)
+        else:
+            raise termError("Logic error (posline): curpoint=",self.curpoint, \
+                'linelengths=',self.linelengths, ", overflow=",pos)
+        self.line = line
+        self.pos = pos
+        (q, r) = divmod(pos, cols)
+        #hanging if at the end of the line and scrsize[1] goes into it evenly
+        self.hanging = pos == ll and r == 0 and pos > 0
+        if self.hanging:
+            self.rowsdown = rd + q - 1
+            self.colloc = cols
+        else:
+            self.rowsdown = rd + q
+            self.colloc = r + 1
 
     def cursorisat(self, point):
         """
@@ -1324,6 +1521,9 @@ class InputString(object):
             current screen cursor position corresponds to 'point'
         """
         self.posfrompoint(point)    # depends on tc.scrsize[1]
+        if tc.knownloc == (self, point, tc.scrsize):
+            return  # cursorto() put it there, nothing printed since: no poll
+        tc.knownloc = None
         self.refreshloc()           # gets row location, if available
     
     def curatinspoint(self):
@@ -1338,6 +1538,9 @@ class InputString(object):
         printing to the screen, repositioning before backspace/delete, and
         paren matching
         """
+        if tc.knownloc == (self, newpoint, tc.scrsize) and \
+                self.curpoint == newpoint and not self.hanging:
+            return      # already there; a hanging cursor gets re-sent anyway
         fromrow = self.rowloc
         rowsup = self.rowsdown
         self.posfrompoint(newpoint)
@@ -1354,6 +1557,7 @@ class InputString(object):
             if self.rowloc != shouldbe:
                 raise termError('Row alignment error: rowloc=', shouldbe, \
                     ' but actually is ', self.rowloc)
+        tc.knownloc = (self, newpoint, tc.scrsize)
         return
     
     def curtoinspoint(self):
@@ -1363,34 +1567,37 @@ class InputString(object):
         # note that using E/F instead of B/A might enable rollback on the 
         # screen, eliminating the error message in cursorto()
         if delta < 0:
-            ourOS.print_(ESC + '[' + str(-delta) + 'A', end='')
+            tc.write(InputString.UPSEQ[-delta] if -delta < 128 \
+                else ESC + '[%dA' % -delta)
         elif delta > 0:
-            ourOS.print_(ESC + '[' + str(delta) + 'B', end='')
-        ourOS.print_(ESC + '[' + str(col) + 'G', end='')
+            tc.write(InputString.DOWNSEQ[delta] if delta < 128 \
+                else ESC + '[%dB' % delta)
+        tc.write(InputString.COLSEQ[col] if col < 256 else ESC + '[%dG' % col)
     
     def eprint(self, s):
         """erase to end of screen. eprint is used (a) when inserting the meta 
         char, the rest of the input string is discarded; (b) when inserting a 
         newline; and (c) when backspacing; (d) with ^C or ^D
         """
+        tc.knownloc = None      # printing may scroll, so poll again
         start = 0
         if self.hanging:
             if self.rowloc == tc.scrsize[0]:   #last character on screen
                 if s == '': return
                 self.rowloc -= 1  #the screen will roll up 1
-            ourOS.print_('\n',end='')
+            tc.write('\n')
             if s == '':
-                ourOS.print_(ESC+'[J', end='')
+                tc.write(ESC+'[J')
                 self.scrgoto(-1, tc.scrsize[1])  # go back up
                 return
             if s[0] == '\n': start = 1
-        ourOS.print_(ESC+'[J'+s[start:], end='')
+        tc.write(ESC+'[J'+s[start:])
     
     def refreshloc(self):
         if tc.sb.switches['l'] == False:
             self.rowloc = None
             return
-        ourOS.print_(ESC + '[6n', end='')
+        tc.write(ESC + '[6n')
         coords =  tc.getcoords('R')
         if coords == None:  #couldn't get from poll
             self.rowloc = None
@@ -1427,14 +1634,15 @@ class InputString(object):
             tc.bell()
             return
         self.curatinspoint()
-        if self.line == 0 or self.pos >= tc.scrsize[1]:   #go as straight up as poss
+        cols = tc.scrsize[1]    # after curatinspoint(), which refreshes it
+        if self.line == 0 or self.pos >= cols:   #go as straight up as poss
             self.inspoint = max(0, \
-                self.inspoint - tc.scrsize[1] - (1 if self.hanging else 0) )
+                self.inspoint - cols - (1 if self.hanging else 0) )
             self.curtoinspoint()
             return
         prevll = self.linelengths[self.line-1]
         onprevrow = 0 if prevll == 0 else \
-            (prevll - 1) % tc.scrsize[1] + 1  #number of chars on the prev row
+            (prevll - 1) % cols + 1  #number of chars on the prev row
         # OK, we want to move straight up, how much do we move self.inspoint?
         # if the last row were the full width of the screen, self.inspoint
         # would go back scrsize[1]+1 (the extra 1 for the \n). But that is going
@@ -1456,18 +1664,19 @@ class InputString(object):
             tc.bell()
             return
         self.curatinspoint()
+        cols = tc.scrsize[1]    # after curatinspoint(), which refreshes it
         curll = self.linelengths[self.line]
         rump = curll - self.pos  #how much left on this line?
-        if rump >= tc.scrsize[1]:  
-            self.inspoint += tc.scrsize[1]
+        if rump >= cols:  
+            self.inspoint += cols
             #check if this leaves in hanging position
-            if rump == tc.scrsize[1] and self.colloc == 1: self.inspoint += 1
+            if rump == cols and self.colloc == 1: self.inspoint += 1
         #already on last line, just go to the end
         elif self.line == len(self.linelengths) - 1:
             self.inspoint = len(self.rstring)
         #some of this line, hangs over, but not enough to go straight down,
         #go to the end of it
-        elif rump + self.colloc > tc.scrsize[1] + 1:
+        elif rump + self.colloc > cols + 1:
             self.inspoint += rump
         else:   # go to next line
             nextll = self.linelengths[self.line + 1]
@@ -1517,7 +1726,7 @@ class InputString(object):
                 bal -= 1
                 if bal == 0:
                     self.cursorto(i)
-                    sys.stdout.flush()
+                    tc.flushout()
                     time.sleep(InputString.FLASHSECS)
                     self.curtoinspoint()
                     return
@@ -1533,33 +1742,37 @@ class ACInputString(InputString):
     self.hanging is only used in eprint, rowup, and rowleft.  If we set it
     false at all times, should work
     """
-    def posfrompoint(self, point):
+    def findpoint(self, point):
         self.curpoint = point
-        self.pos = tc.carriagepos + point
+        pos = tc.carriagepos + point
         rd = 0      # rows down
         self.hanging = False
-        for self.line in range(len(self.linelengths)):
-            ll = self.linelengths[self.line]
-            self.colloc = self.pos % tc.scrsize[1] + 1
-            if self.pos <= ll:    #not hanging, for sure
-                self.rowsdown = rd + self.pos // tc.scrsize[1]
-                return
-            self.pos -= (ll + 1)       # count 1 for the \n
-            rd += max(0, ll-1) // tc.scrsize[1] + 1           # same here
+        cols = tc.scrsize[1]
+        for (line, ll) in enumerate(self.linelengths):
+            if pos <= ll: break     #not hanging, for sure
+            pos -= (ll + 1)       # count 1 for the \n
+            rd += max(0, ll-1) // cols + 1           # same here
                 # use ll-1 because an 80-char line on an 80-char screen won't 
                 # wrap, i.e. the returned value says "if I just printed that, 
                 # how many lines down will I be," rather than "if I want to 
                 # move the insertion point here, how many lines down should 
                 # it be?" #hangovereffect
-        raise termError("Logic error (posline): curpoint=",self.curpoint, \
-            'linelengths=',self.linelengths, ", overflow=",self.pos)
+        else:
+            raise termError("Logic error (posline): curpoint=",self.curpoint, \
+                'linelengths=',self.linelengths, ", overflow=",pos)
+        self.line = line
+        self.pos = pos
+        (q, r) = divmod(pos, cols)
+        self.rowsdown = rd + q
+        self.colloc = r + 1
 
     def eprint(self, s):
         """erase to end of screen. eprint is used (a) when inserting the meta 
         char, the rest of the input string is discarded; (b) when inserting a 
         newline; and (c) when backspacing; (d) with ^C or ^D
         """
-        ourOS.print_(ESC+'[J'+s, end='')
+        tc.knownloc = None
+        tc.write(ESC+'[J'+s)
 
 class specchar:
     """a container for the 'meta character' which terminates #(RS), and the 
@@ -1586,6 +1799,9 @@ class specchar:
             self.ch = newch
 
 class syntclass(specchar):  # subclass for the syntax char, since it needs to update the re
+    protre = re.compile(r'[()]')    # inside protecting parens, only parens matter
+    syntres = {}    # compiled syntre for each syntax character used so far
+    
     def __init__(self,ch):
         specchar.__init__(self,ch)
         self.setre()
@@ -1594,11 +1810,21 @@ class syntclass(specchar):  # subclass for the syntax char, since it needs to up
         specchar.set(self,new,exclude)
         self.setre()
     
-    def setre(self):
-        self.syntre = re.compile('['+self.ch+'(),\n]')
+    def setre(self):    # also rebuilds the main loop's #(ps,#(rs)) string
+        # no \n: parse() strips unprotected newlines from the text in between
+        # escaped, since e.g. ^ or ] would otherwise change the class
+        self.syntre = syntclass.syntres.get(self.ch)
+        if self.syntre == None:
+            self.syntre = syntclass.syntres[self.ch] = \
+                re.compile(r'[' + re.escape(self.ch) + r'(),]')
+        self.syntsearch = self.syntre.search     # bound once for parse()
+        self.strpsrs = self.ch + '(ps,' + self.ch + '(rs))'
+    
+    def getsearch(self):
+        return self.syntsearch
     
-    def getre(self):
-        return self.syntre
+    def getpsrs(self):
+        return self.strpsrs
     
 class block:      # static class to handle the block (disk storage) primitives.
     @staticmethod
@@ -1616,7 +1842,7 @@ class block:      # static class to handle the block (disk storage) primitives.
                 pickle.dump(sblist, out)    # potential problem if forms modified by ss?
         except IOError as e:
             raise tracError(True, '<STE> ',e)
-        for f in sblist: del forms[f.name]  #delete the forms as per Mooers p.66
+        for f in sblist: form.undefine(f.name)  #delete the forms as per Mooers p.66
     
     #FB and EB can't use standard "exact=1" because #(FB) should NOT default to #(FB,)
     #per Mooers
@@ -1630,7 +1856,7 @@ class block:      # static class to handle the block (disk storage) primitives.
                 fblist = pickle.load(input)
         except IOError as e:
             raise tracError(True, '<STE> ',e)
-        for f in fblist: forms[f.name] = f
+        for f in fblist: form.define(f)
     
     @staticmethod
     def erase(*args):           # for EB
@@ -1669,28 +1895,29 @@ class termError(Exception):
         return ' '.join(map(str,self.args))
 
 class SwitchBank:
-    def __init__(self,all,ons):
+    def __init__(self,all,ons,hidden=''):
         self.switches = {}
         for x in list(all):
             self.switches[x] = x in ons
+        self.hidden = hidden    # settable, but left out of vals()
     
-    sre = re.compile('([-+]?)([a-zA-Z])')
-    
-    def flip(self,swstring):
+    def flip(self,swstring):    # e.g. '-p+u' or 'pu'
         i = 0
-        while i < len(swstring):
-            m = SwitchBank.sre.match(swstring[i:])
-            try:
-                self.switches[m.group(2).lower()] = \
-                    (m.group(1) != '-') #'+' or '' are ON
-                i += m.end()
-            except (AttributeError, KeyError):
+        n = len(swstring)
+        while i < n:
+            sign = swstring[i]
+            j = i + 1 if sign in '+-' else i
+            k = swstring[j].lower() if j < n else ''
+            if k not in self.switches:
                 raise primError(False, 'unrecognizable switch string: ', \
                     swstring[i:])
+            self.switches[k] = (sign != '-')    #'+' or '' are ON
+            i = j + 1
     
     def vals(self):
         s = ''
         for k,v in self.switches.items():
+            if k in self.hidden: continue
             s += ('+' if v else '-') + k
         return s
             
@@ -1705,8 +1932,10 @@ class Mode:     # for MO
     executed.  #(mo,s,switches) allows the following switches:
         +/- p for extended primitives, and
         +/- u for unforgiving errors (such as "too many arguments")
+        +/- d for debugging: every form is validated after each pass
     e.g. #(mo,s,-p+u) sets no extended primitives but unforgiving errors
-    #(mo,s) by itself return the state of those switches
+    #(mo,s) by itself return the state of those switches, e.g. +p-u; d is 
+    left out, so that string keeps its T-64-era form
     #(mo,ms,:) modifies the syntactic character, in this case to ':', following
     C.A.R. Kagan... apparently this was easier to type on a Teletype; it's no 
     easier on a standard keyboard, so I switched to the # camp... especially 
@@ -1714,17 +1943,32 @@ class Mode:     # for MO
     initial #s.
     """
 #must be defined above primitives, in case there is a duplicate
-    swextended = SwitchBank('pu','p')   # default is extended prims
-    swunext = SwitchBank('pu','')
+    swextended = SwitchBank('pud','p','d')  # default is extended prims
+    swunext = SwitchBank('pud','','d')
     swactive = swextended               # default is #(mo,e) on startup
+    # copies of swactive's switches, read on every primitive call; refresh()
+    # must be called whenever swactive or its switches change
+    isunforgiving = False
+    isextprim = True
+    isdebug = False
+    
+    @staticmethod
+    def refresh():
+        Mode.isunforgiving = Mode.swactive.switches['u']
+        Mode.isextprim = Mode.swactive.switches['p']
+        Mode.isdebug = Mode.swactive.switches['d']
     
     @staticmethod
     def unforgiving():
-        return Mode.swactive.switches['u']
+        return Mode.isunforgiving
     
     @staticmethod
     def extprim():
-        return Mode.swactive.switches['p']
+        return Mode.isextprim
+    
+    @staticmethod
+    def debug():
+        return Mode.isdebug
     
     @staticmethod
     def extended(m=None):
@@ -1732,6 +1976,7 @@ class Mode:     # for MO
             return Mode.swactive == Mode.swextended
         else:
             Mode.swactive = Mode.swextended if m else Mode.swunext
+            Mode.refresh()
     
     @staticmethod
     def setmode(*args):
@@ -1750,7 +1995,10 @@ class Mode:     # for MO
             if len(args) == 1:
                 return Mode.swextended.vals()
             else:
-                Mode.swextended.flip(args[1])
+                try:
+                    Mode.swextended.flip(args[1])
+                finally:    # flip() may fail after setting some switches
+                    Mode.refresh()
         elif modearg == 'rt': #reactive typewriter
             return Mode.setcontype(*args[1:])
         else:
@@ -1784,9 +2032,11 @@ def trace(*args):       # a flag, used in TN and TF
         tracing = args[0]
         return
 
-class prim:
+class prim(object):     # new-style, for __slots__
     """each 'primitive' is an instance of this class, or its active subclass 
     mathprim"""
+    __slots__ = ('name', 'fn', 'extended', 'minargs', 'maxargs', 'padlen')
+    
     def __init__(self,name,f,**kwargs):
         self.name = name
         self.fn = f
@@ -1797,6 +2047,7 @@ class prim:
         else:
             self.minargs = kwargs['minargs'] if 'minargs' in kwargs else 0
             self.maxargs = kwargs['maxargs'] if 'maxargs' in kwargs else -1
+        self.padlen = max(self.minargs, self.maxargs)    # e.g. EQ has min=3, max=4
         if name in prims:
             raise tracError(True, 'system error: duplicated primitive: ', name)
         prims[name] = self  # add self to list of primitives
@@ -1815,12 +2066,13 @@ class prim:
     
     def fixargs(self,*args):    #pads if necessary, and checks too many or too few
         l = len(args)
-        if Mode.unforgiving():
+        if l == self.padlen: return args    # the usual case: nothing to check or change
+        if Mode.isunforgiving:
             if l < self.minargs:
                 prim.TFAError(l, self.minargs, self.minargs != self.maxargs )
             if self.maxargs >= 0 and l > self.maxargs: 
                 prim.TMAError(l, self.maxargs)
-        padlen = max(self.minargs, self.maxargs)    # e.g. EQ has min=3, max=4
+        padlen = self.padlen
         # because you might conceivably want a null last argument... but need 4 args
         if padlen > l:
             args += ('',) * (padlen-len(args))
@@ -1840,16 +2092,20 @@ class prim:
     
     @staticmethod
     def condTMA(args, num, offset=0, atmost=False ):
-        if len(args) > num and Mode.unforgiving():
+        if len(args) > num and Mode.isunforgiving:
             prim.TMAError(len(args) + offset, num + offset, atmost=atmost)
     
 class mathprim(prim):   # for AD, SU, ML, DV, RM
-    numre = re.compile(r'^(.*?)([+-]?)([0-9]*)\Z',re.DOTALL) #initial ^ is redundant for match
+    __slots__ = ()
+    numcache = {}   # memo of scannum, since loops feed it the same strings
+    CACHESIZE = 4096
+    MEMOMAX = 32    # longer operands are scanned, not hashed and kept
+    lastint = (None, 0)     # (arg, value) of the last tracint, checked first
     
     def __call__(self,*args):
         args = self.fixargs(*args)     #tuples are immutable
         try:
-            (x, prefix) = mathprim.parsenum( args[0] )[0:2]
+            (x, prefix, sign) = mathprim.parsenum( args[0] )
             y = mathprim.tracint( args[1] )
             val = self.fn( x, y )
         except ZeroDivisionError:
@@ -1861,34 +2117,62 @@ class mathprim(prim):   # for AD, SU, ML, DV, RM
         """returns (signed numerical part, prefix part, sign) as per p.53 of 
         Mooers [1972] note that CN distinguishes -0 from 0....
         This is used in the extended form of #(rs)"""
-        m = mathprim.numre.match(arg)
-        unsignedstr = m.group(3)
-        u = 0 if unsignedstr=='' else int(unsignedstr)
-        sign = m.group(2)
-        return ( -u if sign=='-' else u, m.group(1), sign )
+        (n, i, sign) = mathprim.scannum(arg)
+        return ( n, arg[:i], sign )
+    
+    @staticmethod
+    def scannum(arg):   # (signed value, where the prefix ends, sign)
+        i = j = len(arg)
+        memo = j <= mathprim.MEMOMAX
+        if memo:
+            found = mathprim.numcache.get(arg)
+            if found != None: return found
+        while i > 0 and '0' <= arg[i-1] <= '9': i -= 1    # no regex: this is hot
+        u = int(arg[i:j]) if i < j else 0
+        sign = ''
+        if i > 0 and arg[i-1] in '+-':
+            i -= 1
+            sign = arg[i]
+        found = ( -u if sign=='-' else u, i, sign )
+        if memo:
+            if len(mathprim.numcache) >= mathprim.CACHESIZE: mathprim.numcache = {}
+            mathprim.numcache[arg] = found
+        return found
     
     @staticmethod
     def tracint(x):     # used above, and also in GR
-        return mathprim.parsenum(x)[0]
+        (arg, n) = mathprim.lastint
+        if x == arg: return n       # e.g. the same loop bound, over and over
+        n = mathprim.scannum(x)[0]    # skips slicing out the prefix
+        mathprim.lastint = (x, n)
+        return n
 
 class boolprim(prim):
     """this is really a class for static methods, not one we create instances of"""
-    
-    boolre = re.compile(r'([0-7]*)\Z')
+    __slots__ = ()
+    boolcache = {}  # memo of parsebool, bounded like mathprim.numcache
+    CACHESIZE = 1024
     
     @staticmethod
-    def parsebool(arg):
-        m = boolprim.boolre.search(arg)
-        assert m != None
-        octalstr = m.group(1)
-        l = len(octalstr)
-        bits = 0 if l==0 else int(octalstr,8)
-        return (bits, l)    # the value, the length
+    def parsebool(arg):     # the trailing octal digits, scanned back from the end
+        i = j = len(arg)
+        memo = j <= mathprim.MEMOMAX
+        if memo:
+            found = boolprim.boolcache.get(arg)
+            if found != None: return found
+        while i > 0 and '0' <= arg[i-1] <= '7': i -= 1
+        l = j - i
+        bits = 0 if l==0 else int(arg[i:],8)
+        found = (bits, l)    # the value, the length
+        if memo:
+            if len(boolprim.boolcache) >= boolprim.CACHESIZE: boolprim.boolcache = {}
+            boolprim.boolcache[arg] = found
+        return found
     
     @staticmethod
     def tooct(bits, width):
         if width == 0: return ''
-        else: return ('{:0'+str(width)+'o}').format(bits)
+        else: return '%0*o' % (width, bits)    # width from the args, no format string to build
     
     @staticmethod
     def mask(len):
@@ -1913,89 +2197,124 @@ class boolprim(prim):
     
     @staticmethod
     def rotate(d,b):
-        n = mathprim.parsenum(d)[0]
         (val, len) = boolprim.parsebool(b)
         nbits = len * 3
-        rotleft = n % nbits
-        return boolprim.tooct( (val<<rotleft & boolprim.mask(len))
-             | val>>(nbits-rotleft), len )
+        if nbits == 0: return ''    # no bits to rotate (and n % 0 would fail)
+        rotleft = mathprim.tracint(d) % nbits
+        if rotleft == 0: return boolprim.tooct( val, len )
+        return boolprim.tooct( (val<<rotleft | val>>(nbits-rotleft))
+             & boolprim.mask(len), len )
 
     @staticmethod
     def shift(d,b):
-        n = mathprim.parsenum(d)[0]
         (val, len) = boolprim.parsebool(b)
+        n = mathprim.tracint(d)
+        if val == 0 or n >= len*3 or -n >= len*3:    # every bit shifted out
+            return boolprim.tooct( 0, len )
         if n >= 0:
-            return boolprim.tooct ( (val << n) & boolprim.mask(len) if n<len*3 else 0, len)
-        else:
-            n = -n
-            return boolprim.tooct(  val >> n if n < len*3 else 0, len )
+            return boolprim.tooct( (val << n) & boolprim.mask(len), len )
+        return boolprim.tooct( val >> -n, len )
 
 def parse(active):
-    """parse(active) recursively scans an 'active string' of characters as 
-    input.  It returns a triple (neutral, delim, tail), where neutral is the 
-    list of characters which result from parsing the string up to the 
-    separator character sep, which is ',' or ')', and tail is the remaining 
-    active string.  When it finds #( or ##(, it recursively calls itself and 
-    then calls eval to evaluate the expression.  It also handles 'protected' 
-    strings (which are surrounded by parentheses).  Handily, you can call it 
-    from the Python command line: trac.parse('#(ln, )')"""
+    """parse(active) scans an 'active string' of characters as input.  It 
+    returns a triple (neutral, delim, tail), where neutral is the list of 
+    characters which result from parsing the string up to the separator 
+    character sep, which is ',' or ')', and tail is the remaining active 
+    string.  When it finds #( or ##(, it saves the neutral string so far on a 
+    stack of pending calls and starts gathering the arguments; at the closing 
+    ) it calls eval to evaluate the expression and pops the stack.  (It used 
+    to call itself recursively for each argument, which limited how deeply 
+    scripts could nest.)  It also handles 'protected' strings (which are 
+    surrounded by parentheses).  Handily, you can call it from the Python 
+    command line: trac.parse('#(ln, )')"""
     
     global syntchar
     depth = 0   # how many (s
-    neutral = ''   # output so far
+    parts = []  # pieces of the output so far, or of the argument so far inside a call
+    calls = []  # (parts, args, activefn) for each call still gathering args
+    pos = 0     # scan position in active, which is only copied when a call returns
+    sc = syntchar.get()     # re-fetched after each call, which could be #(mo,ms)
+    syntsearch = syntchar.getsearch()
+    protsearch = syntclass.protre.search
+    add = parts.append
+    argadd = None   # args.append of the innermost pending call
     while True:
-        match = syntchar.getre().search(active)
-        if match == None: return (neutral+active, '', '')
-        ch = match.group()
-        neutral += active[0:match.start()]
-        active = active[match.end():]      # which had better be match.start()+1
+        if depth > 0:
+            match = protsearch(active, pos)
+            if match == None:
+                add(active[pos:])
+                break
+            start = match.start()
+            add(active[pos:start])
+        else:
+            match = syntsearch(active, pos)
+            if match == None:
+                add(active[pos:].replace('\n',''))
+                break
+            start = match.start()
+            add(active[pos:start].replace('\n',''))  #strip unprotected 'returns'
+        ch = active[start]
+        pos = start + 1
         if ch == '(':
-            if depth > 0: neutral += ch     #already protected, add it
+            if depth > 0: add(ch)     #already protected, add it
             depth+=1
             continue
         if depth > 0:
             if ch == ')':
                 depth -= 1
                 if depth == 0: continue         #ends protection
-            neutral += ch     # anything else in a protected string
+            add(ch)     # anything else in a protected string
             continue
         
         #depth = 0, so active parsing
-        if ch == '\n': continue     #strip unprotected 'returns'
+        if ch == '\n': continue     #only if the syntax character is \n
         if ch == ',' or ch == ')':
-            return (neutral, ch, active)
-        if ch == syntchar.get():
-            if active[0] == '(':
+            if not calls:
+                return (''.join(parts), ch, active[pos:])
+            argadd(''.join(parts))    # that's another argument
+            if ch == ',':
+                parts = []
+                add = parts.append
+                continue
+            (parts, args, activefn) = calls.pop()
+            add = parts.append
+            if calls: argadd = calls[-1][1].append
+            (result, activefn) = eval(args, activefn)
+            sc = syntchar.get()
+            syntsearch = syntchar.getsearch()
+            if activefn:
+                active = result + active[pos:]
+                pos = 0
+            else:   # 'neutral'
+                add(result)
+            continue    # the call has been executed, continue parsing
+        if ch == sc:
+            n = len(active)     # index checks: no ch+'(' to build for each #
+            if pos < n and active[pos] == '(':
                 activefn = True      #active function: #(...)
-                active = active[1:]
-            elif active[0:2] == ( ch + '(' ):   # ch is equal to the syntchar
+                pos += 1
+            elif pos+1 < n and active[pos] == ch and active[pos+1] == '(':   # ch is equal to the syntchar
                 activefn = False    #neutral function: ##(...)
-                active = active[2:]
+                pos += 2
             else:   # not a call, just a random syntax character
-                neutral += ch
+                add(ch)
                 continue
             #OK, it's a call, gather the arguments
             args = []
-            while True:
-                (arg, delim, active) = parse(active)
-                args.append(arg)
-                if delim == ',': continue
-                if delim == ')':
-                    (result, activefn) = eval(args, activefn)
-                    if activefn:
-                        active = result + active
-                    else:   # 'neutral'
-                        neutral +=result
-                    break   # we executed the call
-                if delim == '':
-                    raise tracError(False, "<UNF> hit end of string while expecting ')'")
-                assert False    #unexpected delimiter
-            continue    # if you get here, the call has been executed, continue parsing
+            calls.append( (parts, args, activefn) )
+            argadd = args.append
+            parts = []
+            add = parts.append
+            continue
         assert False    # unrecognized match to syntre
+    # the string has run out
+    if calls:
+        raise tracError(False, "<UNF> hit end of string while expecting ')'")
+    return (''.join(parts), '', '')
 
 def eval(arglist, act):     # when a function call is assembled by the parser, this executes
     global activeImpliedCall
-    if trace():
+    if tracing:     # the global itself: this runs for every call
         s = syntchar.get()
         ourOS.print_(s+'/' if act else s+s+'/',arglist[0],end=' ')
         for a in arglist[1:]:
@@ -2005,14 +2324,20 @@ def eval(arglist, act):     # when a function call is assembled by the parser, t
         if input != '\n':
             trace(False)
             raise KeyboardInterrupt
-    pname = arglist[0].lower()
-    if pname in prims:
-        p = prims[pname]
-        if Mode.extprim() or not p.extended:
-            val = prims[pname](*arglist[1:])
+    p = prims.get(arglist[0])   # prim names are lower case, usually so is the call
+    if p == None: p = prims.get(arglist[0].lower())
+    if p != None:
+        if Mode.isextprim or not p.extended:
+            n = len(arglist)    # the prim name plus its arguments
+            if n == 3: val = p(arglist[1], arglist[2])   # common arities: no slice
+            elif n == 2: val = p(arglist[1])
+            elif n == 4: val = p(arglist[1], arglist[2], arglist[3])
+            elif n == 1: val = p()
+            else: val = p(*arglist[1:])
             #if val == None: val = ''
-            if isinstance(val,str): return (val, act)
-            if isinstance(val,tuple):    # some prims force active "default" argument
+            t = type(val)   # exact types: no prim returns a subclass of either
+            if t is str: return (val, act)
+            if t is tuple:    # some prims force active "default" argument
                 assert len(val) == 2
                 return (val[0], act or val[1])  #val[1] forces active for "default call"
             return ('',act)     #ds, for example returns the 'form' type; throw it away
@@ -2027,7 +2352,8 @@ prims = {}      # dict of the 'primitives'
 # these are the primitives, pretty much in the order of Mooers spec
 
 prim( 'ps', ( lambda x: tc.printstr(x) ), exact=1 )
-# tc can change, so need to do it this way
+# tc can change, so need to do it this way (so too for the other lambdas
+# below that use globals); static methods can be registered directly
 
 prim( 'rs', ( lambda *a: tc.readstr(*a) ) )     # extended form of RS 1/11/15
 
@@ -2037,9 +2363,9 @@ prim( 'rc', ( lambda: tc.readch() ), exact=0 )
 
 prim( 'ds', form, exact=2)
 
-prim( 'dd', ( lambda *a: form.deletedef(*a) ) )
+prim( 'dd', form.deletedef )
 
-prim( 'da', ( lambda: form.deleteall() ), exact=0 )
+prim( 'da', form.deleteall, exact=0 )
 
 prim( 'ss', ( lambda x, *a: form.find(x).segment(*a) ), minargs=1 )
 
@@ -2059,15 +2385,15 @@ prim( 'cn', form.callN, minargs=2, maxargs=3 )
 
 prim( 'in', form.initial, minargs=2, maxargs=3 )
 
-mathprim( 'ad', ( lambda x,y: x + y ), minargs=2, maxargs=3 )
+mathprim( 'ad', operator.add, minargs=2, maxargs=3 )   # C functions, no lambda frame
 
-mathprim( 'su', ( lambda x,y: x - y ), minargs=2, maxargs=3 )
+mathprim( 'su', operator.sub, minargs=2, maxargs=3 )
 
-mathprim( 'ml', ( lambda x,y: x * y ), minargs=2, maxargs=3 )
+mathprim( 'ml', operator.mul, minargs=2, maxargs=3 )
 
-mathprim( 'dv', ( lambda x,y: x // y ), minargs=2, maxargs=3 )
+mathprim( 'dv', operator.floordiv, minargs=2, maxargs=3 )
 
-mathprim( 'rm', ( lambda x,y: x % y ), minargs=2, maxargs=3, extended=True )
+mathprim( 'rm', operator.mod, minargs=2, maxargs=3, extended=True )
 
 prim( 'bu', boolprim.union, exact=2 )
 
@@ -2091,7 +2417,7 @@ prim( 'fb', block.fetch )
 
 prim( 'eb', block.erase )
 
-prim( 'ln', ( lambda x: x.join(forms) ), exact=1 )
+prim( 'ln', ( lambda x: x.join(form.names) ), exact=1 )
 
 prim( 'pf', ( lambda x: ourOS.print_(form.find(x)) ), exact=1 )
 
@@ -2112,6 +2438,7 @@ def main(*args):
         print('Error:', str(e))
     rshistory = []
     forms = {}      # the defined strings
+    form.names = []
     syntchar = syntclass('#')
     metachar = specchar("'")
     activeImpliedCall = False   # in case there is a call to NI before an implied call
@@ -2134,14 +2461,14 @@ def main(*args):
 def psrs():     # the main loop
     #global syntchar
     while True:
-        strpsrs = syntchar.get() + '(ps,' + syntchar.get() + '(rs))'
+        strpsrs = syntchar.getpsrs()
         tc.printstr(strpsrs+'\n> ')
         try:
-            remainder = ''.join( parse(strpsrs) )
+            (neutral, delim, tail) = parse(strpsrs)
             ourOS.print_('')    #blank line
-            if remainder != '':
+            if neutral or delim or tail:    # e.g. an extra ')' in the input
                 raise tracError(False, '<UNF> unbalanced parens: ' \
-                    'after parsing, remainder = ' + remainder)
+                    'after parsing, remainder = ' + neutral + delim + tail)
         except tracHalt:            # terminate: HL or EOF (^D)
             return
         except tracError as e:
@@ -2153,9 +2480,10 @@ def psrs():     # the main loop
             ourOS.print_( str(e) )
         except KeyboardInterrupt:   # ^C or non-empty input while trace on
             ourOS.print_('<INT>')
-        except RuntimeError as e:   # mostly recursion depth exceeding (e.g #(fact,1000) )
+        except RuntimeError as e:   # parse() no longer recurses, so #(fact,1000) is OK
             ourOS.print_( '<SCE>', str(e) )
-        finally:            # for debugging, OK to comment out
-            for f in forms: forms[f].validate()
+        finally:            # #(mo,s,+d); python -O compiles it away
+            if __debug__ and Mode.isdebug:
+                for f in forms.values(): f.validate()
 
 if __name__ == '__main__': main(*sys.argv[1:])